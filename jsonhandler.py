@@ -129,19 +129,23 @@ def getUnknownBytes(fname):
 # run this method in the end to store the output in the 'path' directory as OUT_FNAME
 # pass a list of filenames (you can use 'unknowns'), a list of your
 # predicted authors and optionally a list of the scores (both must of
-# course be in the same order as the 'texts' list)
+# course be in the same order as the 'texts' list); 'fname' defaults to OUT_FNAME
+# the file is written under a temporary name first and then renamed, so that
+# readers never see a partially written file
 
 
-def storeJson(path, texts, cands, scores=None):
+def storeJson(path, texts, cands, scores=None, fname=OUT_FNAME):
     answers = []
     if scores == None:
         scores = [1 for text in texts]
     for i in range(len(texts)):
         answers.append(
             {"unknown_text": texts[i], "author": cands[i], "score": scores[i]})
-    f = open(os.path.join(path, OUT_FNAME), "w")
+    tmp = os.path.join(path, fname + ".tmp")
+    f = open(tmp, "w")
     json.dump({"answers": answers}, f, indent=2)
     f.close()
+    os.replace(tmp, os.path.join(path, fname))
 
 # if you want to evaluate your answers using the ground-truth.json, load
 # the true authors in 'trueAuthors' using this function
@@ -19,15 +19,26 @@ Description:
     For more information, see the paper: https://bit.ly/2K22ACM
 """
 
+import os
+import sys
+import gzip
+import json
 import math
+import contextlib
 import random
 import argparse
 import jsonhandler
 
+from array import array
+
 
 # length of feature list
 FEATURE_LENGTH = 20000
 
+# Length of feature list per n-gram size, e.g. {3: 5000, 4: 15000}
+# (None means one combined list of FEATURE_LENGTH features)
+FEATURE_LENGTHS = None
+
 # Minimum size of doc (increases precision, decreases recall if many small docs)
 MINLEN = 0
 
@@ -37,6 +48,9 @@ MINTRAINLEN = 500
 # Size of n-gram
 NGRAM_SIZE = 4
 
+# Sizes of n-grams extracted together (mixed n-gram features)
+NGRAM_SIZES = [NGRAM_SIZE]
+
 # Number of k-repetitions
 REPETITIONS = 100
 
@@ -49,20 +63,51 @@ def create_vector(string):
 
     Gets a string (e.g. Book), splits it into and
     returns a vector with all possible n-grams/features.
+
+    The n-grams of all NGRAM_SIZES are extracted in a single
+    pass over each word: only the n-grams of the longest size
+    (and the shorter tails at the end of a word) are counted,
+    and the shorter n-grams are derived from their prefixes.
+    Words that are not longer than an n-gram size are added
+    once as a whole.
     """
     vec = {}
+    tails = {}
     words = string.split()
+    sizes = sorted(NGRAM_SIZES)
+    shortest = sizes[0]
+    longest = sizes[-1]
 
     for word in words:
-        if len(word) <= NGRAM_SIZE:
+        wlen = len(word)
+        if wlen <= longest and wlen not in sizes:
             add(vec, word)
-        else:
-            for i in range(len(word) - NGRAM_SIZE + 1):
-                add(vec, word[i : i + NGRAM_SIZE])
+        for i in range(wlen - shortest + 1):
+            add(tails, word[i : i + longest])
+
+    for tail, count in tails.items():
+        for size in sizes:
+            if size > len(tail):
+                break
+            ngram = tail[:size]
+            vec[ngram] = vec.get(ngram, 0) + count
 
     return vec
 
 
+def ngram_size(ngram):
+    """Returns the n-gram size a feature belongs to.
+
+    Whole words shorter than an n-gram size belong to
+    the smallest n-gram size they fit in.
+    """
+    for size in sorted(NGRAM_SIZES):
+        if len(ngram) <= size:
+            return size
+
+    return len(ngram)
+
+
 def add(vector, ngram):
     """Adds n-grams to the vector.
 
@@ -81,11 +126,26 @@ def select_features(vec):
 
     Selects the x most frequent n-grams/features
     (x=FEATURE_LENGTH) to avoid a (possibly) too
-    big featurelist.
+    big featurelist. If FEATURE_LENGTHS is set, the
+    most frequent features are selected per n-gram size.
     """
-    return sorted(vec, key=vec.get, reverse=True)[
-        : min(len(vec), FEATURE_LENGTH)
-    ]
+    if FEATURE_LENGTHS is None:
+        return sorted(vec, key=vec.get, reverse=True)[
+            : min(len(vec), FEATURE_LENGTH)
+        ]
+
+    groups = {size: [] for size in FEATURE_LENGTHS}
+
+    for ngram in vec:
+        size = ngram_size(ngram)
+        if size in groups:
+            groups[size].append(ngram)
+
+    features = []
+    for size, length in FEATURE_LENGTHS.items():
+        features += sorted(groups[size], key=vec.get, reverse=True)[:length]
+
+    return features
 
 
 def create_feature_map(string, features):
@@ -206,29 +266,173 @@ def get_random_string(string, length):
     return "".join(words[random_part : random_part + length])
 
 
-def main():
-    """The main function."""
-    parser = argparse.ArgumentParser(
-        description="PPM approach according to Koppel11"
-    )
+def score_rounds(utext, candidates, texts, feature_list, minwords):
+    """Returns the per-round similarities of an unknown text.
 
-    parser.add_argument("-i", action="store", help="path to corpus directory")
-    parser.add_argument("-o", action="store", help="path to output directory")
+    Runs REPETITIONS rounds, each on a random half of the feature
+    list, and returns one list of candidate similarities per round.
+    Returns None if the unknown text is shorter than MINLEN.
+    """
+    ulen = len(utext.split())
 
-    args = vars(parser.parse_args())
+    if ulen < MINLEN:
+        return None
 
-    corpusdir = args["i"]
-    outputdir = args["o"]
+    textlen = min(ulen, minwords)
+    print(textlen)
+    ustring = "".join(utext.split()[:textlen])
+    rounds = []
 
-    if corpusdir is None or outputdir is None:
-        parser.print_help()
-        return
+    for _ in range(REPETITIONS):
+        rfl = random.sample(feature_list, len(feature_list) // 2)
+        sims = []
+        for cand in candidates:
+            candstring = get_random_string(texts[cand], textlen)
+            sims.append(test_sim(candstring, ustring, rfl, 1))
+        rounds.append(sims)
 
-    candidates = jsonhandler.candidates
-    unknowns = jsonhandler.unknowns
+    return rounds
+
+
+def decide(rounds, candidates, threshold=THRESHOLD, aggregate="wins"):
+    """Returns the attributed author and score of an unknown text.
+
+    With aggregate="wins" the score is the fraction of rounds won by
+    the best candidate; with aggregate="mean" it is the best mean
+    similarity over all rounds. Scores below the threshold (and texts
+    without rounds) are attributed to "None".
+    """
+    if rounds is None:
+        return "None", 0
+
+    if aggregate == "mean":
+        totals = [sum(column) / len(rounds) for column in zip(*rounds)]
+    else:
+        totals = [0] * len(candidates)
+        for sims in rounds:
+            totals[sims.index(max(sims))] += 1
+        totals = [wins / float(len(rounds)) for wins in totals]
+
+    score = max(totals)
+
+    if score >= threshold:
+        return candidates[totals.index(score)], score
+
+    return "None", score
+
+
+def open_log(path, candidates, unknowns, shard=None):
+    """Opens a round log for writing and stores its header.
+
+    The log is a gzipped file starting with a JSON header line,
+    followed by REPETITIONS * len(candidates) doubles per unknown.
+    The header also keeps the shard (i, N) the unknowns belong to.
+    """
+    log = gzip.open(path, "wb")
+    header = {
+        "candidates": candidates,
+        "unknowns": unknowns,
+        "repetitions": REPETITIONS,
+        "byteorder": sys.byteorder,
+        "shard": shard,
+    }
+    log.write(json.dumps(header).encode("utf-8") + b"\n")
+    return log
+
+
+def write_rounds(log, rounds, ncands):
+    """Appends the rounds of one unknown text to a round log.
+
+    Unknown texts without rounds are stored as NaN so that every
+    record keeps the same size.
+    """
+    if rounds is None:
+        values = array("d", [math.nan] * (REPETITIONS * ncands))
+    else:
+        values = array("d", [sim for sims in rounds for sim in sims])
+
+    log.write(values.tobytes())
+
+
+def read_log(path):
+    """Reads a round log written by open_log and write_rounds.
+
+    Returns the header and a generator yielding the rounds
+    (or None) of every unknown text in order. Exits if the
+    log ends before the record of an unknown text is complete.
+    """
+    log = gzip.open(path, "rb")
+    header = json.loads(log.readline().decode("utf-8"))
+    ncands = len(header["candidates"])
+    reps = header["repetitions"]
+
+    def records():
+        with log:
+            for file in header["unknowns"]:
+                values = array("d")
+                size = values.itemsize * reps * ncands
+                try:
+                    data = log.read(size)
+                except EOFError:
+                    data = b""
+                if len(data) != size:
+                    raise SystemExit(f"Log {path} is truncated at {file}")
+                values.frombytes(data)
+                if header["byteorder"] != sys.byteorder:
+                    values.byteswap()
+                if values and math.isnan(values[0]):
+                    yield None
+                else:
+                    yield [
+                        list(values[i : i + ncands])
+                        for i in range(0, len(values), ncands)
+                    ]
+
+    return header, records()
+
+
+def replay(logpath, outputdir, threshold=THRESHOLD, aggregate="wins"):
+    """Recomputes answers.json from a round log.
+
+    Applies the given threshold and aggregation rule to the stored
+    similarities without reading the corpus again. Logs of a shard
+    are replayed into the partial answers file of that shard.
+    """
+    header, records = read_log(logpath)
+    authors = []
+    scores = []
+
+    for rounds in records:
+        author, score = decide(
+            rounds, header["candidates"], threshold, aggregate
+        )
+        authors.append(author)
+        scores.append(score)
+
+    print("Storing answers...")
+    fname = jsonhandler.OUT_FNAME
+
+    if header.get("shard") is not None:
+        fname = shard_fname(*header["shard"])
+
+    jsonhandler.storeJson(
+        outputdir, header["unknowns"], authors, scores, fname
+    )
+    print("Done!")
+
+
+def load_training(corpusdir):
+    """Loads the training texts of all candidates.
+
+    Reads the meta file and training texts of the corpus, drops
+    candidates with less than MINTRAINLEN words and returns the
+    remaining candidates, their texts, the word count of the shortest
+    text and the feature list.
+    """
     jsonhandler.loadJson(corpusdir)
     jsonhandler.loadTraining()
 
+    candidates = jsonhandler.candidates
     texts = {}
     corpus = ""
     print("Loading texts for training...")
@@ -257,42 +461,341 @@ def main():
     print(minwords)
 
     feature_list = training(corpus)
+    return candidates, texts, minwords, feature_list
+
+
+def parse_sizes(value):
+    """Parses a comma-separated list of positive integers."""
+    try:
+        sizes = [int(part) for part in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid list: {value}")
+
+    if min(sizes) < 1:
+        raise argparse.ArgumentTypeError(f"invalid list: {value}")
+
+    return sizes
+
+
+def parse_shard(value):
+    """Parses a shard given as "i/N" into the tuple (i, N)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value}")
+
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value}")
+
+    return index, count
+
+
+def parse_count(value):
+    """Parses a shard count N (a positive integer)."""
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard count: {value}")
+
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"invalid shard count: {value}")
+
+    return count
+
+
+def shard_fname(index, count):
+    """Returns the name of the partial answers file of a shard."""
+    return f"answers.shard{index}of{count}.json"
+
+
+def merge(outputdir, unknowns, count):
+    """Merges the partial answers files of all shards.
+
+    Reads the partial answers files of the count shards in outputdir
+    and stores the final answers.json in the order of unknowns. Exits
+    if a shard is missing, if outputdir also holds shards of another
+    count, if a shard is incomplete or if an unknown text was
+    attributed by more than one shard.
+    """
+    fnames = [shard_fname(index, count) for index in range(count)]
+
+    for fname in os.listdir(outputdir):
+        if (
+            fname.startswith("answers.shard")
+            and fname.endswith(".json")
+            and fname not in fnames
+        ):
+            raise SystemExit(
+                f"Shard {fname} does not belong to {count} shards"
+            )
+
+    answers = {}
+
+    for fname in fnames:
+        path = os.path.join(outputdir, fname)
+        if not os.path.isfile(path):
+            raise SystemExit(f"Shard {fname} is missing")
+        try:
+            with open(path) as file:
+                shard = [
+                    (answer["unknown_text"], answer)
+                    for answer in json.load(file)["answers"]
+                ]
+        except (ValueError, KeyError, TypeError):
+            raise SystemExit(f"Shard {fname} is incomplete")
+
+        for name, answer in shard:
+            if name in answers:
+                raise SystemExit(f"{name} is in more than one shard")
+            answers[name] = answer
+
+    missing = [file for file in unknowns if file not in answers]
+
+    if missing:
+        raise SystemExit(f"No answers for {len(missing)} unknown texts")
+
+    print("Storing answers...")
+    jsonhandler.storeJson(
+        outputdir,
+        unknowns,
+        [answers[file]["author"] for file in unknowns],
+        [answers[file]["score"] for file in unknowns],
+    )
+    print("Done!")
+
+
+def read_stream(file):
+    """Yields the unknown texts of a JSON lines stream.
+
+    Every line is a JSON object with the name of the unknown text
+    ("unknown_text") and its content ("text"). Empty and invalid
+    lines are reported on stderr and yielded without a text, so
+    that every line still gets an answer.
+    """
+    for number, line in enumerate(file, 1):
+        name = None
+
+        if not line.strip():
+            print(f"Line {number} is empty", file=sys.stderr)
+            yield name, None
+            continue
+
+        try:
+            doc = json.loads(line)
+            name = doc.get("unknown_text")
+            if not isinstance(name, str) or not isinstance(doc["text"], str):
+                raise ValueError("unknown_text and text must be strings")
+        except (ValueError, KeyError, AttributeError) as error:
+            print(f"Line {number} invalid: {error!r}", file=sys.stderr)
+            yield name, None
+        else:
+            yield name, doc["text"]
+
+
+def attribute_stream(docs, candidates, texts, feature_list, minwords, args):
+    """Yields one answer per unknown text of a stream.
+
+    Scores every (name, text) pair of docs against the trained
+    candidates as soon as it is read. Texts that could not be read
+    are attributed to "None".
+    """
+    for name, utext in docs:
+        rounds = None
+        if utext is not None:
+            print(f"Testing {name}")
+            rounds = score_rounds(
+                utext, candidates, texts, feature_list, minwords
+            )
+        author, score = decide(
+            rounds, candidates, args["t"], args["aggregate"]
+        )
+        yield {"unknown_text": name, "author": author, "score": score}
+
+
+def stream(file, corpusdir, args):
+    """Attributes a JSON lines stream of unknown texts.
+
+    Reads unknown texts from the open file and writes one JSON
+    answer line per input line to stdout as soon as it is attributed.
+    Progress messages go to stderr to keep stdout parseable.
+    """
+    out = sys.stdout
+
+    with contextlib.redirect_stdout(sys.stderr):
+        candidates, texts, minwords, feature_list = load_training(corpusdir)
+        docs = read_stream(file)
+
+        for answer in attribute_stream(
+            docs, candidates, texts, feature_list, minwords, args
+        ):
+            out.write(json.dumps(answer) + "\n")
+            out.flush()
+
+
+def main():
+    """The main function."""
+    parser = argparse.ArgumentParser(
+        description="PPM approach according to Koppel11"
+    )
+
+    parser.add_argument("-i", action="store", help="path to corpus directory")
+    parser.add_argument("-o", action="store", help="path to output directory")
+    parser.add_argument(
+        "-l", action="store", help="path to write the per-round log to"
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--replay",
+        action="store",
+        help="recompute answers from a per-round log instead of the corpus",
+    )
+    parser.add_argument(
+        "-t",
+        action="store",
+        type=float,
+        default=THRESHOLD,
+        help="score threshold (needed for open set)",
+    )
+    parser.add_argument(
+        "--aggregate",
+        action="store",
+        choices=["wins", "mean"],
+        default="wins",
+        help="how to turn the rounds into a score",
+    )
+    parser.add_argument(
+        "-n",
+        action="store",
+        type=parse_sizes,
+        help="comma-separated n-gram sizes to extract together",
+    )
+    parser.add_argument(
+        "-f",
+        action="store",
+        type=parse_sizes,
+        help="feature list length, or one length per n-gram size",
+    )
+    mode.add_argument(
+        "--stream",
+        action="store",
+        help="attribute JSON lines of unknown texts from a file or - (stdin)",
+    )
+    mode.add_argument(
+        "--shard",
+        action="store",
+        type=parse_shard,
+        help="only attribute every N-th unknown text, starting at i (i/N)",
+    )
+    mode.add_argument(
+        "--merge",
+        action="store",
+        type=parse_count,
+        metavar="N",
+        help="merge the partial answers of N shards into answers.json",
+    )
+
+    args = vars(parser.parse_args())
+
+    global NGRAM_SIZES, FEATURE_LENGTH, FEATURE_LENGTHS
+
+    if args["n"] is not None:
+        if len(set(args["n"])) != len(args["n"]):
+            parser.error("-n must not repeat an n-gram size")
+        NGRAM_SIZES = args["n"]
+
+    if args["f"] is not None:
+        if len(args["f"]) == 1:
+            FEATURE_LENGTH = args["f"][0]
+        elif len(args["f"]) == len(NGRAM_SIZES):
+            FEATURE_LENGTHS = dict(zip(NGRAM_SIZES, args["f"]))
+        else:
+            parser.error("-f needs one length or one per n-gram size")
+
+    corpusdir = args["i"]
+    outputdir = args["o"]
+    logpath = args["l"]
+
+    if logpath is not None and (
+        args["replay"] is not None
+        or args["merge"] is not None
+        or args["stream"] is not None
+    ):
+        parser.error("-l can not be used with --replay, --merge or --stream")
+
+    if args["replay"] is not None:
+        if corpusdir is not None:
+            parser.error("--replay does not read the corpus (-i)")
+        if outputdir is None:
+            parser.error("--replay needs an output directory (-o)")
+        replay(args["replay"], outputdir, args["t"], args["aggregate"])
+        return
+
+    if args["stream"] is not None:
+        if corpusdir is None:
+            parser.error("--stream needs the corpus (-i)")
+        if outputdir is not None:
+            parser.error("--stream writes its answers to stdout, not -o")
+
+        if args["stream"] == "-":
+            stream(sys.stdin, corpusdir, args)
+            return
+
+        try:
+            file = open(args["stream"], encoding="utf-8")
+        except OSError as error:
+            parser.error(f"can not open --stream file: {error}")
+
+        with file:
+            stream(file, corpusdir, args)
+        return
+
+    unknowns = jsonhandler.unknowns
+
+    if args["merge"] is not None:
+        if corpusdir is None or outputdir is None:
+            parser.error("--merge needs the corpus (-i) and output (-o)")
+        jsonhandler.loadJson(corpusdir)
+        merge(outputdir, unknowns, args["merge"])
+        return
+
+    if corpusdir is None or outputdir is None:
+        parser.print_help()
+        return
+
+    candidates, texts, minwords, feature_list = load_training(corpusdir)
+    fname = jsonhandler.OUT_FNAME
+
+    if args["shard"] is not None:
+        index, count = args["shard"]
+        unknowns = unknowns[index::count]
+        fname = shard_fname(index, count)
+
     authors = []
     scores = []
+    log = None
+
+    if logpath is not None:
+        log = open_log(logpath, candidates, unknowns, args["shard"])
 
     for file in unknowns:
         print(f"Testing {file}")
         utext = jsonhandler.getUnknownText(file)
-        ulen = len(utext.split())
+        rounds = score_rounds(utext, candidates, texts, feature_list, minwords)
 
-        if ulen < MINLEN:
-            authors.append("None")
-            scores.append(0)
-        else:
-            wins = [0] * len(candidates)
-            textlen = min(ulen, minwords)
-            print(textlen)
-            ustring = "".join(utext.split()[:textlen])
-
-            for _ in range(REPETITIONS):
-                rfl = random.sample(feature_list, len(feature_list) // 2)
-                sims = []
-                for cand in candidates:
-                    candstring = get_random_string(texts[cand], textlen)
-                    sims.append(test_sim(candstring, ustring, rfl, 1))
-                wins[sims.index(max(sims))] += 1
-
-            score = max(wins) / float(REPETITIONS)
-
-            if score >= THRESHOLD:
-                authors.append(candidates[wins.index(max(wins))])
-                scores.append(score)
-            else:
-                authors.append("None")
-                scores.append(score)
+        if log is not None:
+            write_rounds(log, rounds, len(candidates))
+
+        author, score = decide(
+            rounds, candidates, args["t"], args["aggregate"]
+        )
+        authors.append(author)
+        scores.append(score)
+
+    if log is not None:
+        log.close()
 
     print("Storing answers...")
-    jsonhandler.storeJson(outputdir, unknowns, authors, scores)
+    jsonhandler.storeJson(outputdir, unknowns, authors, scores, fname)
     print("Done!")
 
 